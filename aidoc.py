@@ -1,17 +1,44 @@
 import argparse
 import ast
+import asyncio
+import configparser
 import dataclasses
 import datetime
-import glob
+import functools
+import hashlib
+import json
 import logging
 import os
+import re
+import sqlite3
+import subprocess
+import sys
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, NamedTuple, Optional, Tuple, Union
-
-import astor
-import black
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import httpx
 import openai
+from openai import AsyncOpenAI
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+from tqdm import tqdm
+
+if sys.version_info < (3, 9):
+    raise RuntimeError("aidoc requires Python 3.9 or higher")
 
 logger = logging.getLogger("aidoc")
 handler = logging.StreamHandler()
@@ -20,7 +47,49 @@ logger.setLevel(logging.INFO)
 
 CONFIG_DIR = Path("~/.config/aidoc")
 API_KEY, MODEL = None, None
-DEFAULT_MODEL = "code-davinci-002"
+CLIENT: Optional[AsyncOpenAI] = None
+DEFAULT_MODEL = "gpt-4o-mini"
+LEGACY_MODEL_PREFIXES = (
+    "code-",
+    "text-",
+    "davinci",
+    "curie",
+    "babbage",
+    "ada",
+    "gpt-3.5-turbo-instruct",
+)
+DEFAULT_MAX_CONCURRENT = 10
+SEM: Optional[asyncio.Semaphore] = None
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You write concise Google-style docstrings.",
+}
+PROMPT_TEMPLATE = (
+    "For each of the following {count} Python objects, write a concise, "
+    "high-quality docstring in Google style. A class docstring must only have "
+    "a one liner about the class. A function docstring must have one liner "
+    "about the function, 'Args' and 'Returns' (only if it's a "
+    "function/method). Respond as a JSON object mapping each object's number "
+    "to its docstring text, without surrounding quotes.\n\nObjects:\n{objects}"
+)
+OBJECT_TEMPLATE = "{index}. {object_type}\n{code}"
+BATCH_SIZE = 10
+BATCH_POLL_INTERVAL = 30
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+BATCH_TIMEOUT_MS = 50
+CHECKPOINT_INTERVAL = 5 * BATCH_SIZE
+EXCLUDED_DIRS = {".git", "__pycache__", ".venv", "node_modules"}
+
+
+def positive_int(value: str) -> int:
+    """Parses a command line value as an integer of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not an integer")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def cli():
@@ -47,7 +116,13 @@ def cli():
         "--format",
         action="store_true",
         default=True,
-        help="format the entire source file using black (default=True)",
+        help="format the updated source files using black (default=True)",
+    )
+    gen_parser.add_argument(
+        "--no-format",
+        dest="format",
+        action="store_false",
+        help="don't format the updated source files",
     )
     gen_parser.add_argument(
         "-pr",
@@ -55,6 +130,17 @@ def cli():
         action="store_true",
         help="create a pull request with the changes",
     )
+    gen_parser.add_argument(
+        "--max-concurrent",
+        type=positive_int,
+        default=DEFAULT_MAX_CONCURRENT,
+        help=f"maximum number of concurrent OpenAI requests (default={DEFAULT_MAX_CONCURRENT})",
+    )
+    gen_parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="use the OpenAI Batch API for directories (cheaper, results can take up to 24h)",
+    )
     subcommands.add_parser("configure", help="configure API key and model")
 
     args = parser.parse_args()
@@ -81,6 +167,8 @@ class ExtractedFunction:
         True if the docstring was generated by GPT-3, False otherwise
     is_code_updated : bool
         True if the code was updated with the generated docstring, False otherwise
+    node : Optional[ast.FunctionDef]
+        AST node the function was extracted from
     """
 
     name: str
@@ -90,6 +178,7 @@ class ExtractedFunction:
     code: str = ""
     is_docstring_generated: bool = False
     is_code_updated: bool = False
+    node: Optional[ast.AST] = dataclasses.field(default=None, repr=False)
 
 
 @dataclass
@@ -110,6 +199,8 @@ class ExtractedClass:
         True if the docstring was generated by GPT-3, False otherwise
     is_code_updated : bool
         True if the code was updated with the generated docstring, False otherwise
+    node : Optional[ast.ClassDef]
+        AST node the class was extracted from
     """
 
     name: str
@@ -118,6 +209,7 @@ class ExtractedClass:
     code: str = ""
     is_docstring_generated: bool = False
     is_code_updated: bool = False
+    node: Optional[ast.AST] = dataclasses.field(default=None, repr=False)
 
 
 def read_source_file(source_path: Path) -> str:
@@ -132,9 +224,7 @@ def read_source_file(source_path: Path) -> str:
     source : str
 
     """
-    with open(source_path, "r") as f:
-        source = f.read()
-    return source
+    return source_path.read_bytes().decode("utf-8")
 
 
 def write_source_file(source_path: Path, updated_source: str) -> None:
@@ -150,21 +240,23 @@ def write_source_file(source_path: Path, updated_source: str) -> None:
     None
 
     """
-    with open(source_path, "w") as f:
-        f.write(updated_source)
+    source_path.write_bytes(updated_source.encode("utf-8"))
 
 
 def extract(
-    source: str,
+    tree: ast.Module,
 ) -> Tuple[List[ExtractedFunction], List[ExtractedClass]]:
 
     """
-    Extracts functions and classes from a source file.
+    Extracts functions and classes from a parsed source file.
+
+    The extracted objects keep a reference to their AST node so that
+    docstrings can later be inserted into the same tree.
 
     Parameters
     ----------
-    source : str
-        Source code
+    tree : ast.Module
+        Parsed source code
 
     Returns
     -------
@@ -174,33 +266,59 @@ def extract(
         List of classes in the source file
     """
 
-    tree = ast.parse(source)
+    collector = Collector()
+    collector.visit(tree)
+    return collector.functions, collector.classes
 
-    functions = []
-    classes = []
-
-    for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef):
-            functions.append(extract_function(node))
-        if isinstance(node, ast.ClassDef):
-            name = node.name
-            methods = []
-            docstring = ast.get_docstring(node)
-
-            for child in node.body:
-                if isinstance(child, ast.FunctionDef):
-                    methods.append(extract_function(child))
-
-            classes.append(
-                ExtractedClass(
-                    name=name,
-                    methods=methods,
-                    docstring=docstring,
-                    code=astor.to_source(node),
-                )
-            )
 
-    return functions, classes
+class Collector(ast.NodeVisitor):
+    """Collects module-level functions, classes and their methods.
+
+    Only statement blocks are descended into, and never the bodies of
+    functions, so expressions and nested function bodies are not visited.
+
+    Attributes
+    ----------
+    functions : List[ExtractedFunction]
+        Functions and methods, in source order
+    classes : List[ExtractedClass]
+        Classes, including classes nested in other classes
+    """
+
+    def __init__(self):
+        self.functions: List[ExtractedFunction] = []
+        self.classes: List[ExtractedClass] = []
+
+    def generic_visit(self, node: ast.AST) -> None:
+        for field in ("body", "orelse", "finalbody", "handlers", "cases"):
+            children = getattr(node, field, None)
+            if isinstance(children, list):
+                for child in children:
+                    self.visit(child)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> None:
+        self.functions.append(extract_function(node))
+
+    def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef) -> None:
+        # async functions aren't documented, and their bodies aren't searched
+        pass
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> None:
+        class_ = ExtractedClass(
+            name=node.name,
+            docstring=ast.get_docstring(node),
+            code=ast.unparse(node),
+            node=node,
+        )
+        self.classes.append(class_)
+
+        for child in node.body:
+            if isinstance(child, ast.FunctionDef):
+                method = extract_function(child)
+                class_.methods.append(method)
+                self.functions.append(method)
+            elif isinstance(child, ast.ClassDef):
+                self.visit_ClassDef(child)
 
 
 def extract_function(node: ast.FunctionDef) -> ExtractedFunction:
@@ -228,45 +346,41 @@ def extract_function(node: ast.FunctionDef) -> ExtractedFunction:
         args=args,
         returns=returns,
         docstring=docstring,
-        code=astor.to_source(node),
+        code=ast.unparse(node),
+        node=node,
     )
 
 
-def insert_docstring(
-    source: str,
-    function_or_class: Union[ExtractedFunction, ExtractedClass],
+def insert_docstring_inplace(
+    node: Union[ast.FunctionDef, ast.ClassDef],
+    docstring: str,
     overwrite=False,
-) -> str:
-    """Inserts a docstring into a function in a source code and returns the updated code string.
+) -> bool:
+    """Inserts a docstring into a function/class definition, modifying the node in place.
 
     Parameters
     ----------
-    source_file : str
-    function : ExtractedFunction
+    node : Union[ast.FunctionDef, ast.ClassDef]
+    docstring : str
+    overwrite : bool
 
     Returns
     -------
-    updated_source : str
+    inserted : bool
+        True if the docstring was inserted, False if an existing one was kept
     """
 
-    tree = ast.parse(source)
-
-    for node in ast.walk(tree):
-        if (
-            isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef)
-        ) and node.name == function_or_class.name:
-            docstring = ast.get_docstring(node)
-            if docstring and len(docstring.strip()) > 0 and not overwrite:
-                logger.info(
-                    f"{node.name}'s docstring already exists. Skipping..."
-                )
-                continue
-            delete_docstring(node)
-            node.body.insert(0, ast.Expr(ast.Str(function_or_class.docstring)))
-            break
-
-    updated_source = astor.to_source(tree)
-    return updated_source
+    existing_docstring = ast.get_docstring(node)
+    if (
+        existing_docstring
+        and len(existing_docstring.strip()) > 0
+        and not overwrite
+    ):
+        logger.info(f"{node.name}'s docstring already exists. Skipping...")
+        return False
+    delete_docstring(node)
+    node.body.insert(0, ast.Expr(ast.Constant(docstring)))
+    return True
 
 
 def delete_docstring(node: ast.FunctionDef) -> None:
@@ -285,13 +399,320 @@ def delete_docstring(node: ast.FunctionDef) -> None:
         node.body.pop(0)
 
 
-def generate_docstring(code_snippet, object_type) -> Tuple[str, bool]:
-    """Generates a docstring for a function using OpenAI's GPT-3 API.
+@retry(
+    retry=retry_if_exception_type(
+        (openai.RateLimitError, openai.APITimeoutError)
+    ),
+    wait=wait_exponential(min=1, max=60),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def create_completion(**kwargs):
+    """Creates a chat completion, retrying with exponential backoff on rate limits and timeouts.
+
+    Parameters
+    ----------
+    **kwargs
+        Arguments passed to the OpenAI chat completions API
+
+    Returns
+    -------
+    response : openai.types.chat.ChatCompletion
+    """
+    return await CLIENT.chat.completions.create(**kwargs)
+
+
+def build_request(snippets: List[Tuple[str, str]]) -> dict:
+    """Builds the chat completion request body asking for docstrings of several code snippets.
+
+    Parameters
+    ----------
+    snippets : List[Tuple[str, str]]
+        (code snippet, object type) pairs for which docstrings are to be generated
+
+    Returns
+    -------
+    body : dict
+        Arguments for the OpenAI chat completions API
+    """
+
+    openai_model = MODEL or DEFAULT_MODEL
+
+    objects = "\n\n".join(
+        OBJECT_TEMPLATE.format(index=i, object_type=object_type, code=code)
+        for i, (code, object_type) in enumerate(snippets, start=1)
+    )
+    prompt = PROMPT_TEMPLATE.format(count=len(snippets), objects=objects)
+    return dict(
+        model=openai_model,
+        messages=[SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+        response_format={"type": "json_object"},
+        temperature=0,
+        max_tokens=250 * len(snippets),
+        top_p=1.0,
+        frequency_penalty=0.0,
+        presence_penalty=0.0,
+    )
+
+
+def parse_response(
+    content: Optional[str], count: int
+) -> List[Tuple[str, bool]]:
+    """Parses the JSON answer to a request built by `build_request`.
+
+    Parameters
+    ----------
+    content : Optional[str]
+        Message content returned by the model
+    count : int
+        Number of snippets in the request
+
+    Returns
+    -------
+    results : List[Tuple[str, bool]]
+        (docstring, success) pair for every snippet, in the same order
+    """
+    try:
+        mapping = json.loads(content)
+    except Exception as e:
+        logger.error(f"Unable to generate docstring\n error: {e}")
+        return [("", False)] * count
+
+    if not isinstance(mapping, dict):
+        mapping = {}
+
+    results = []
+    for i in range(1, count + 1):
+        docstring = mapping.get(str(i))
+        if isinstance(docstring, str):
+            results.append((docstring, True))
+        else:
+            logger.error(f"Unable to generate docstring for object {i}")
+            results.append(("", False))
+    return results
+
+
+@functools.lru_cache(maxsize=1)
+def get_cache() -> sqlite3.Connection:
+    """Opens the docstring cache, creating it under CONFIG_DIR if needed.
+
+    Returns
+    -------
+    cache : sqlite3.Connection
+    """
+    config_dir = CONFIG_DIR.expanduser()
+    config_dir.mkdir(parents=True, exist_ok=True)
+    cache = sqlite3.connect(config_dir / "cache.sqlite")
+    cache.execute("PRAGMA journal_mode=WAL")
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS docs(key TEXT PRIMARY KEY, doc TEXT)"
+    )
+    return cache
+
+
+def cache_key(code_snippet: str, object_type: str) -> str:
+    """Returns the cache key of a code snippet for the configured model."""
+    openai_model = MODEL or DEFAULT_MODEL
+    return hashlib.sha256(
+        f"{openai_model}|{object_type}|{code_snippet}".encode("utf-8")
+    ).hexdigest()
+
+
+def cached_docstrings(snippets: List[Tuple[str, str]]) -> List[Optional[str]]:
+    """Looks up previously generated docstrings for several code snippets.
+
+    Parameters
+    ----------
+    snippets : List[Tuple[str, str]]
+        (code snippet, object type) pairs
+
+    Returns
+    -------
+    docstrings : List[Optional[str]]
+        Cached docstring for every snippet, None on a cache miss
+    """
+    cache = get_cache()
+    docstrings = []
+    for code_snippet, object_type in snippets:
+        row = cache.execute(
+            "SELECT doc FROM docs WHERE key=?",
+            (cache_key(code_snippet, object_type),),
+        ).fetchone()
+        docstrings.append(row[0] if row else None)
+    return docstrings
+
+
+def cache_docstrings(
+    snippets: List[Tuple[str, str]], results: List[Tuple[str, bool]]
+) -> None:
+    """Stores the successfully generated docstrings of several code snippets.
+
+    Parameters
+    ----------
+    snippets : List[Tuple[str, str]]
+        (code snippet, object type) pairs
+    results : List[Tuple[str, bool]]
+        (docstring, success) pair for every snippet
+
+    Returns
+    -------
+    None
+    """
+    cache = get_cache()
+    with cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO docs(key, doc) VALUES (?, ?)",
+            [
+                (cache_key(code_snippet, object_type), docstring)
+                for (code_snippet, object_type), (docstring, success) in zip(
+                    snippets, results
+                )
+                if success and docstring
+            ],
+        )
+
+
+async def generate_docstrings(
+    snippets: List[Tuple[str, str]]
+) -> List[Tuple[str, bool]]:
+    """Generates docstrings for several code snippets with a single request to OpenAI's Chat Completions API.
+
+    Snippets that were already documented by a previous run are answered
+    from the cache and are not sent to the API.
+
+    Parameters
+    ----------
+    snippets : List[Tuple[str, str]]
+        (code snippet, object type) pairs for which docstrings are to be generated
+
+    Returns
+    -------
+    results : List[Tuple[str, bool]]
+        (docstring, success) pair for every snippet, in the same order
+    """
+    cached = cached_docstrings(snippets)
+    misses = [i for i, docstring in enumerate(cached) if docstring is None]
+    results = [(docstring, True) for docstring in cached]
+    if not misses:
+        return results
+
+    missing_snippets = [snippets[i] for i in misses]
+    global SEM
+    if SEM is None:
+        SEM = asyncio.Semaphore(DEFAULT_MAX_CONCURRENT)
+
+    try:
+        async with SEM:
+            response = await create_completion(
+                **build_request(missing_snippets)
+            )
+    except Exception as e:
+        logger.error(f"Unable to generate docstring\n error: {e}")
+        generated = [("", False)] * len(missing_snippets)
+    else:
+        generated = parse_response(
+            response.choices[0].message.content, len(missing_snippets)
+        )
+        cache_docstrings(missing_snippets, generated)
+
+    for i, result in zip(misses, generated):
+        results[i] = result
+    return results
+
+
+class DocstringBatcher:
+    """Coalesces concurrent single-snippet requests into batched requests.
+
+    Requests are held for up to `timeout_ms` (or until `batch_size` are
+    waiting) and then sent together with `generate_docstrings`, so
+    snippets from different files can share one API call.
+
+    Attributes
+    ----------
+    batch_size : int
+        Maximum number of snippets per request
+    timeout_ms : float
+        How long the first waiting snippet is held before its batch is sent
+    """
+
+    def __init__(
+        self,
+        batch_size: int = BATCH_SIZE,
+        timeout_ms: float = BATCH_TIMEOUT_MS,
+    ):
+        self.batch_size = batch_size
+        self.timeout_ms = timeout_ms
+        self._pending: List[Tuple[Tuple[str, str], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(
+        self, code_snippet: str, object_type: str
+    ) -> Tuple[str, bool]:
+        """Queues a snippet and waits for the batch it ends up in.
+
+        Parameters
+        ----------
+        code_snippet : str
+        object_type : str
+
+        Returns
+        -------
+        docstring : str
+            Generated docstring
+        success : bool
+            True if the docstring was generated successfully, False otherwise
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((code_snippet, object_type), future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.timeout_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            task = asyncio.ensure_future(self._run(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(
+        self, pending: List[Tuple[Tuple[str, str], asyncio.Future]]
+    ) -> None:
+        try:
+            results = await generate_docstrings(
+                [snippet for snippet, _ in pending]
+            )
+        except Exception as e:
+            logger.error(f"Unable to generate docstring\n error: {e}")
+            results = [("", False)] * len(pending)
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+
+BATCHER = DocstringBatcher()
+
+
+async def generate_docstring(
+    code_snippet: str, object_type: str
+) -> Tuple[str, bool]:
+    """Generates a docstring for a function/class.
+
+    Concurrent calls are coalesced into batched requests by BATCHER.
 
     Parameters
     ----------
     code_snippet : str
         Code snippet for which the docstring is to be generated
+    object_type : str
+        "function" or "class"
 
     Returns
     -------
@@ -300,34 +721,167 @@ def generate_docstring(code_snippet, object_type) -> Tuple[str, bool]:
     success : bool
         True if the docstring was generated successfully, False otherwise
     """
+    return await BATCHER.submit(code_snippet, object_type)
+
+
+def needs_docstring(
+    function_or_class: Union[ExtractedFunction, ExtractedClass],
+    overwrite=False,
+) -> bool:
+    """Checks whether a docstring should be generated for a function/class.
+
+    Parameters
+    ----------
+    function_or_class : Union[ExtractedFunction, ExtractedClass]
+    overwrite : bool
+
+    Returns
+    -------
+    needed : bool
+        False for `__init__` and for objects that are already documented (unless overwrite)
+    """
+    if function_or_class.name == "__init__":
+        return False
+    docstring = function_or_class.docstring
+    return overwrite or not (docstring and docstring.strip())
+
+
+def select_targets(
+    functions: List[ExtractedFunction],
+    classes: List[ExtractedClass],
+    overwrite=False,
+) -> List[Tuple[Union[ExtractedFunction, ExtractedClass], str]]:
+    """Selects the functions and classes that need a docstring.
+
+    Parameters
+    ----------
+    functions : List[ExtractedFunction]
+    classes : List[ExtractedClass]
+    overwrite : bool
+
+    Returns
+    -------
+    targets : List[Tuple[Union[ExtractedFunction, ExtractedClass], str]]
+        (function or class, object type) pairs
+    """
+    return [
+        (function, "function")
+        for function in functions
+        if needs_docstring(function, overwrite)
+    ] + [
+        (class_, "class")
+        for class_ in classes
+        if needs_docstring(class_, overwrite)
+    ]
+
+
+def batch_targets(
+    functions: List[ExtractedFunction],
+    classes: List[ExtractedClass],
+    overwrite=False,
+) -> List[List[Tuple[Union[ExtractedFunction, ExtractedClass], str]]]:
+    """Groups the functions and classes that need a docstring into batches of up to BATCH_SIZE.
 
-    openai.api_key = API_KEY
-    openai_model = MODEL or "code-davinci-002"
+    Parameters
+    ----------
+    functions : List[ExtractedFunction]
+    classes : List[ExtractedClass]
+    overwrite : bool
 
-    if object_type == "class":
-        prompt = f"""# Python 3.7\n \n{code_snippet}\n\n# write a concise, high-quality docstring for the above {object_type} in Google style.  It must only have a one liner about the {object_type}:\n\"\"\""""
+    Returns
+    -------
+    batches : List[List[Tuple[Union[ExtractedFunction, ExtractedClass], str]]]
+        (function or class, object type) pairs, grouped per request
+    """
+    targets = select_targets(functions, classes, overwrite=overwrite)
+    return [
+        targets[i : i + BATCH_SIZE] for i in range(0, len(targets), BATCH_SIZE)
+    ]
+
+
+def apply_docstrings(
+    batch: List[Tuple[Union[ExtractedFunction, ExtractedClass], str]],
+    results: List[Tuple[str, bool]],
+    overwrite=False,
+) -> bool:
+    """Stores the generated docstrings on a batch of targets and inserts them into their AST nodes.
+
+    Parameters
+    ----------
+    batch : List[Tuple[Union[ExtractedFunction, ExtractedClass], str]]
+    results : List[Tuple[str, bool]]
+    overwrite : bool
+
+    Returns
+    -------
+    updated : bool
+        True if at least one docstring was inserted
+    """
+    updated = False
+    for (target, _), result in zip(batch, results):
+        target.docstring, target.is_docstring_generated = result
+        if target.is_docstring_generated and len(target.docstring) > 0:
+            target.is_code_updated = insert_docstring_inplace(
+                target.node, target.docstring, overwrite=overwrite
+            )
+            updated = updated or target.is_code_updated
+    return updated
+
+
+def save_file(source_file: Path, tree: ast.Module, changed: bool) -> None:
+    """Writes the updated source file.
+
+    The tree is only printed back to source and written when a docstring
+    was actually inserted.
+
+    Parameters
+    ----------
+    source_file : Path
+    tree : ast.Module
+        Parsed source code, with the generated docstrings inserted
+    changed : bool
+        True if at least one docstring was inserted into the tree
+
+    Returns
+    -------
+    None
+    """
+    if changed:
+        write_source_file(source_file, ast.unparse(tree) + "\n")
+        logger.info(f"✅ Docstrings generated for {source_file}")
     else:
-        prompt = f"""# Python 3.7\n \n{code_snippet}\n\n# write a concise, high-quality docstring for the above {object_type} in Google style.  It must have one liner about the {object_type}, 'Args' and 'Returns' (only if it's a function/method):\n\"\"\""""
-    try:
-        response = openai.Completion.create(
-            model=openai_model,
-            prompt=prompt,
-            temperature=0,
-            max_tokens=250,
-            top_p=1.0,
-            frequency_penalty=0.0,
-            presence_penalty=0.0,
-            stop=["#", '"""'],
-        )
-        return response.choices[0].text, True
-    except Exception as e:
-        logger.error(f"Unable to generate docstring\n error: {e}")
-        return "", False
+        logger.info(f"🙏 {source_file} unchanged.")
+
 
+def format_files(source_files: List[Path]) -> None:
+    """Formats source files with a single black run.
+
+    Parameters
+    ----------
+    source_files : List[Path]
 
-def process_file(source_file: Path, args: NamedTuple):
+    Returns
+    -------
+    None
+    """
+    result = subprocess.run(
+        [sys.executable, "-m", "black", "--fast", "--quiet"]
+        + [source_file.as_posix() for source_file in source_files],
+        check=False,
+    )
+    if result.returncode != 0:
+        logger.error("❌ Unable to format files with black.")
+
+
+async def process_file(source_file: Path, args: NamedTuple) -> bool:
     """Processes a single file and generates docstrings for functions and classes.
 
+    Docstrings for all functions and classes in the file are requested
+    concurrently and batched by BATCHER, together with those of any other
+    file being processed at the same time. Docstrings are inserted as they
+    arrive, and the file is written every CHECKPOINT_INTERVAL docstrings so
+    that progress survives an interrupted run.
+
     Parameters
     ----------
     source_file : Path
@@ -335,49 +889,333 @@ def process_file(source_file: Path, args: NamedTuple):
 
     Returns
     -------
-    None
+    changed : bool
+        True if the file was updated
     """
 
     source = read_source_file(source_file)
-    source_copy = source[:]
-    functions, classes = extract(source)
-    for function in functions:
-        if function.name == "__init__":
+    tree = ast.parse(source)
+    functions, classes = extract(tree)
+
+    targets = select_targets(functions, classes, overwrite=args.overwrite)
+    if not targets:
+        logger.info(f"🙏 {source_file} unchanged.")
+        return False
+
+    async def generate(target, object_type):
+        result = await generate_docstring(target.code, object_type)
+        return (target, object_type), result
+
+    changed = False
+    progress = tqdm(
+        total=len(targets),
+        desc=source_file.name,
+        unit="docstring",
+        leave=False,
+        disable=None,
+    )
+    with progress:
+        for completed, task in enumerate(
+            asyncio.as_completed(
+                [
+                    generate(target, object_type)
+                    for target, object_type in targets
+                ]
+            ),
+            start=1,
+        ):
+            try:
+                pair, result = await task
+            except Exception as e:
+                logger.error(f"Unable to generate docstring\n error: {e}")
+                continue
+            if apply_docstrings([pair], [result], overwrite=args.overwrite):
+                changed = True
+            progress.update()
+            if (
+                changed
+                and completed % CHECKPOINT_INTERVAL == 0
+                and completed < len(targets)
+            ):
+                write_source_file(source_file, ast.unparse(tree) + "\n")
+
+    save_file(source_file, tree, changed)
+    return changed
+
+
+async def process_files_batch(
+    python_files: List[Path], args: NamedTuple
+) -> List[Path]:
+    """Processes several files with a single job on OpenAI's Batch API.
+
+    The Batch API is cheaper and not subject to the regular rate limits,
+    but results can take up to 24 hours to arrive. Cached docstrings are
+    inserted right away and are not submitted.
+
+    Parameters
+    ----------
+    python_files : List[Path]
+    args : NamedTuple
+
+    Returns
+    -------
+    changed_files : List[Path]
+        Files that were updated
+    """
+
+    files = {}
+    lines = []
+    for source_file in python_files:
+        try:
+            source = read_source_file(source_file)
+            tree = ast.parse(source)
+        except Exception as e:
+            logger.error(f"❌ Unable to process {source_file}\n error: {e}")
             continue
-        (
-            function.docstring,
-            function.is_docstring_generated,
-        ) = generate_docstring(function.code, "function")
-        if function.is_docstring_generated and len(function.docstring) > 0:
-            source = insert_docstring(
-                source, function, overwrite=args.overwrite
+        functions, classes = extract(tree)
+        batches = batch_targets(functions, classes, overwrite=args.overwrite)
+        if not batches:
+            logger.info(f"🙏 {source_file} unchanged.")
+            continue
+
+        changed = False
+        pending = []
+        for batch in batches:
+            snippets = [
+                (target.code, object_type) for target, object_type in batch
+            ]
+            cached = cached_docstrings(snippets)
+            hits = [
+                (pair, (docstring, True))
+                for pair, docstring in zip(batch, cached)
+                if docstring is not None
+            ]
+            if hits and apply_docstrings(
+                [pair for pair, _ in hits],
+                [result for _, result in hits],
+                overwrite=args.overwrite,
+            ):
+                changed = True
+            misses = [
+                pair
+                for pair, docstring in zip(batch, cached)
+                if docstring is None
+            ]
+            if not misses:
+                continue
+            lines.append(
+                json.dumps(
+                    {
+                        "custom_id": f"{source_file.as_posix()}|{len(pending)}",
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": build_request(
+                            [
+                                (target.code, object_type)
+                                for target, object_type in misses
+                            ]
+                        ),
+                    }
+                )
             )
+            pending.append(misses)
+        files[source_file.as_posix()] = (source_file, tree, pending, changed)
+
+    responses = {}
+    if lines:
+        # cache hits are already in their trees, so save them even if the
+        # job fails
+        try:
+            responses = await run_batch_job(lines) or {}
+        except Exception as e:
+            logger.error(f"❌ Batch job failed.\n error: {e}")
+
+    changed_files = []
+    for key, (source_file, tree, pending, changed) in files.items():
+        for i, batch in enumerate(pending):
+            content = responses.get(f"{key}|{i}")
+            if content is None:
+                continue
+            snippets = [
+                (target.code, object_type) for target, object_type in batch
+            ]
+            results = parse_response(content, len(batch))
+            cache_docstrings(snippets, results)
+            if apply_docstrings(batch, results, overwrite=args.overwrite):
+                changed = True
+        save_file(source_file, tree, changed)
+        if changed:
+            changed_files.append(source_file)
+    return changed_files
+
+
+async def run_batch_job(lines: List[str]) -> Optional[Dict[str, str]]:
+    """Submits requests to OpenAI's Batch API and waits for the results.
+
+    The uploaded input file and the files produced by the job are deleted
+    from the OpenAI account afterwards.
+
+    Parameters
+    ----------
+    lines : List[str]
+        JSONL request lines
 
-    for class_ in classes:
-        (
-            class_.docstring,
-            class_.is_docstring_generated,
-        ) = generate_docstring(class_.code, "class")
-        if class_.is_docstring_generated and len(function.docstring) > 0:
-            source = insert_docstring(source, class_, overwrite=args.overwrite)
-
-    write_source_file(source_file, source)
-
-    if args.format:
-        black.format_file_in_place(
-            Path(source_file),
-            fast=False,
-            mode=black.FileMode(),
-            write_back=black.WriteBack.YES,
+    Returns
+    -------
+    responses : Optional[Dict[str, str]]
+        Message content of every successful request keyed by custom_id,
+        None if the batch did not complete
+    """
+    batch_input = await CLIENT.files.create(
+        file=("aidoc-batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    file_ids = [batch_input.id]
+    try:
+        job = await CLIENT.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
         )
+        logger.info(f"⏳ Submitted batch {job.id} with {len(lines)} requests.")
 
-    if source != source_copy:
-        logger.info(f"✅ Docstrings generated for {source_file}")
-    else:
-        logger.info(f"🙏 {source_file} unchanged.")
+        while job.status not in BATCH_FINAL_STATUSES:
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            job = await CLIENT.batches.retrieve(job.id)
+        file_ids += [job.output_file_id, job.error_file_id]
+
+        if job.status != "completed" or not job.output_file_id:
+            logger.error(f"❌ Batch {job.id} {job.status}.")
+            return None
+
+        output = await CLIENT.files.content(job.output_file_id)
+    finally:
+        await delete_files(file_ids)
+
+    responses = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            logger.error(
+                f"Unable to generate docstring for {item['custom_id']}\n error: {item.get('error')}"
+            )
+            continue
+        responses[item["custom_id"]] = response["body"]["choices"][0][
+            "message"
+        ]["content"]
+    return responses
+
+
+async def delete_files(file_ids: List[Optional[str]]) -> None:
+    """Deletes files from the OpenAI account, logging any failure.
+
+    Parameters
+    ----------
+    file_ids : List[Optional[str]]
+        File ids to delete; None entries are ignored
+
+    Returns
+    -------
+    None
+    """
+    for file_id in file_ids:
+        if not file_id:
+            continue
+        try:
+            await CLIENT.files.delete(file_id)
+        except Exception as e:
+            logger.error(f"Unable to delete file {file_id}\n error: {e}")
+
+
+async def process_path(source_path: Path, args: NamedTuple) -> None:
+    """Processes a source file or every Python file in a directory(recursive).
+
+    Files in a directory are streamed to `max_concurrent` workers as they
+    are discovered; the shared semaphore still bounds the number of
+    in-flight OpenAI requests. Updated files are then formatted with a
+    single black run and, if requested, a PR is created for each. The
+    OpenAI client is closed once all requests are done.
+
+    Parameters
+    ----------
+    source_path : Path
+    args : NamedTuple
+
+    Returns
+    -------
+    None
+    """
+    global SEM
+
+    # created here so that it binds to the running loop (Python 3.9)
+    SEM = asyncio.Semaphore(args.max_concurrent)
+
+    changed_files = []
+    try:
+        if os.path.isfile(source_path):
+            if await process_file(source_path, args):
+                changed_files.append(source_path)
+        elif os.path.isdir(source_path) and args.batch:
+            changed_files = await process_files_batch(
+                list(iter_py_files(source_path)), args
+            )
+        elif os.path.isdir(source_path):
+            python_files = iter_py_files(source_path)
+
+            async def worker():
+                for python_file in python_files:
+                    try:
+                        if await process_file(python_file, args):
+                            changed_files.append(python_file)
+                    except Exception as e:
+                        logger.error(
+                            f"❌ Unable to process {python_file}\n error: {e}"
+                        )
+
+            await asyncio.gather(
+                *(worker() for _ in range(args.max_concurrent))
+            )
+    finally:
+        if CLIENT is not None:
+            await CLIENT.close()
+
+    if args.format and changed_files:
+        format_files(changed_files)
 
     if args.pull_request:
-        create_pr(source_file)
+        for changed_file in changed_files:
+            create_pr(changed_file)
+
+
+def iter_py_files(
+    root: Path, exclude: Set[str] = EXCLUDED_DIRS
+) -> Iterator[Path]:
+    """Recursively yields the Python files in a directory.
+
+    Hidden entries and directories listed in `exclude` are pruned without
+    being descended into.
+
+    Parameters
+    ----------
+    root : Path
+    exclude : Set[str]
+        Directory names to skip
+
+    Returns
+    -------
+    python_files : Iterator[Path]
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name in exclude:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_py_files(Path(entry.path), exclude)
+            elif entry.is_file() and entry.name.endswith(".py"):
+                yield Path(entry.path)
 
 
 def create_pr(source_file: Path) -> None:
@@ -394,18 +1232,30 @@ def create_pr(source_file: Path) -> None:
 
     source_file = source_file.as_posix()
 
-    diff = os.popen(f"git diff {source_file}").read()
-    if len(diff) == 0:
-        logger.error(f"❌ Can't create PR.")
-        return
-    git_branch = f"add-docstrings-to-{source_file}-{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
-    os.system(f"git checkout -b {git_branch}")
-    os.system(f"git add {source_file}")
-    os.system(f'git commit -m "add docstrings to {source_file}"')
-    os.system(f"git push -u origin {git_branch}")
-    os.system(
-        f"gh pr create -f -t 'add docstrings to {source_file}' -b 'add docstrings to {source_file}'"
-    )
+    try:
+        diff = subprocess.run(
+            ["git", "diff", "--", source_file],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        if len(diff) == 0:
+            logger.error(f"❌ Can't create PR.")
+            return
+        branch_name = re.sub(r"[^\w./-]", "-", source_file)
+        git_branch = f"add-docstrings-to-{branch_name}-{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}"
+        message = f"add docstrings to {source_file}"
+        subprocess.run(["git", "checkout", "-b", git_branch], check=True)
+        subprocess.run(
+            ["git", "commit", "-m", message, "--", source_file], check=True
+        )
+        subprocess.run(["git", "push", "-u", "origin", git_branch], check=True)
+        subprocess.run(
+            ["gh", "pr", "create", "-f", "-t", message, "-b", message],
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error(f"❌ Can't create PR.\n error: {e}")
 
 
 def configure():
@@ -414,7 +1264,7 @@ def configure():
     while not api_key:
         api_key = input("Enter the OpenAI API key: ")
     model = input(
-        "Enter the OpenAI model to use (default: code-davinci-002): "
+        f"Enter the OpenAI model to use (default: {DEFAULT_MODEL}): "
     )
     if len(model.strip()) == 0:
         model = DEFAULT_MODEL
@@ -428,19 +1278,25 @@ def configure():
     with open(config_path, "w") as config_file:
         config_file.write(f"OPENAI_API_KEY={api_key}\n")
         config_file.write(f"OPENAI_MODEL={model}\n")
+    read_config.cache_clear()
 
     return api_key, model
 
 
+@functools.lru_cache(maxsize=1)
 def read_config():
-    """Reads the API key and model from the configuration file."""
+    """Reads the API key and model from the configuration file.
+
+    The result is cached; `configure` clears the cache after saving.
+    """
     try:
         config_dir = CONFIG_DIR.expanduser()
-        with open(config_dir / "config.ini", "r") as config_file:
-            lines = config_file.readlines()
-            api_key = lines[0].strip().split("=")[1]
-            model = lines[1].strip().split("=")[1]
-            return api_key, model
+        parser = configparser.ConfigParser(interpolation=None)
+        parser.read_string(
+            "[default]\n" + (config_dir / "config.ini").read_text()
+        )
+        config = parser["default"]
+        return config.get("OPENAI_API_KEY"), config.get("OPENAI_MODEL")
     except Exception as e:
         logger.error(f"Unable to read configuration file")
         return None, None
@@ -452,7 +1308,7 @@ def main():
     Options:
         -h --help to see more options
     """
-    global API_KEY, MODEL
+    global API_KEY, MODEL, CLIENT
 
     args = cli()
 
@@ -468,14 +1324,25 @@ def main():
     if not API_KEY and not MODEL:
         API_KEY, MODEL = configure()
 
-    source_path = args.source_file
+    if MODEL and MODEL.startswith(LEGACY_MODEL_PREFIXES):
+        logger.warning(
+            f"⚠️ {MODEL} is a legacy completions model and can't be used "
+            f"with the Chat Completions API. Using {DEFAULT_MODEL} instead; "
+            "run `aidoc configure` to choose another model."
+        )
+        MODEL = DEFAULT_MODEL
+
+    CLIENT = AsyncOpenAI(
+        api_key=API_KEY,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=64, max_keepalive_connections=32
+            )
+        ),
+    )
 
-    if os.path.isfile(source_path):
-        process_file(source_path, args)
-    elif os.path.isdir(source_path):
-        python_files = glob.glob(f"{source_path}/**/*.py", recursive=True)
-        for python_file in python_files:
-            process_file(python_file, args)
+    asyncio.run(process_path(args.source_file, args))
 
 
 if __name__ == "__main__":